@@ -1,15 +1,39 @@
 import os
-import re
+import io
+import argparse
+import csv
 import json
-import pandas as pd
-from PIL import Image
+import hashlib
+import base64
+import mimetypes
+from PIL import Image, ImageOps
 import pytesseract
+try:
+    from tesserocr import PyTessBaseAPI, OEM, PSM
+except ImportError:  # Optional: fall back to the pytesseract CLI wrapper
+    PyTessBaseAPI = None
+try:
+    from orjson import loads as json_loads  # Raises a json.JSONDecodeError subclass
+except ImportError:  # Optional: fall back to the stdlib parser
+    json_loads = json.loads
+try:
+    import h2  # Lets httpx multiplex API requests over HTTP/2
+except ImportError:  # Optional: stay on HTTP/1.1 keep-alive connections
+    h2 = None
+try:
+    import tiktoken
+except ImportError:  # Optional: fall back to a characters-per-token estimate
+    tiktoken = None
 import logging
-from openai import OpenAI
+from parse import parse_receipt_text, clean_item_name, COLUMN_ORDER, IMAGE_EXTENSIONS, _WS_RE
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, APITimeoutError
 from dotenv import load_dotenv
 import time
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 import threading
+from collections import Counter
 # Removed unused imports for cleaner code
 
 # Load environment variables
@@ -22,22 +46,41 @@ logger = logging.getLogger(__name__)
 # --- CONFIGURATION ---
 RECEIPTS_DIR = 'data/receipts'
 OUTPUT_CSV = 'data/ai_improved.csv'
-BATCH_SIZE = 10  # Larger batches for speed
-MAX_WORKERS = 5  # More concurrent workers for parallel processing
+MAX_WORKERS = 32  # Concurrent OpenAI requests in flight (asyncio semaphore)
+OCR_WORKERS = int(os.getenv('OCR_CONCURRENCY', os.cpu_count() or 1))  # Tesseract processes (CPU-bound)
+MODEL = os.getenv('OPENAI_MODEL', "gpt-4o")  # e.g. gpt-4o-mini for cheaper bulk runs
+SERVICE_TIER = os.getenv('OPENAI_SERVICE_TIER')  # e.g. "flex" on models that offer it; unset uses the default tier
+API_TIMEOUT = 15.0  # Base seconds per OpenAI request, before allowing for output length
+SERVICE_TIER_TIMEOUT = 900.0  # Seconds to wait on SERVICE_TIER; flex queues requests, OpenAI suggests up to 15 minutes
+BATCH_API_TIMEOUT = 300.0  # Seconds per Batch API call; uploads and result downloads can be many MB
+API_TOKENS_PER_SECOND = 50  # Conservative generation speed used to size per-request timeouts
+API_MAX_RETRIES = 4  # SDK-level retries for connection errors, 429s and 5xx
+RATE_LIMIT_RPM = int(os.getenv('OPENAI_RPM', 500))  # Requests per minute allowed for MODEL
+RATE_LIMIT_TPM = int(os.getenv('OPENAI_TPM', 800000))  # Tokens per minute allowed for MODEL
+CACHE_DIR = 'data/cache'  # OCR text and AI responses, safe to delete
+OCR_LANG = 'aze'
+OCR_VERSION = 4  # Bump when OCR settings change to invalidate cached text
+OCR_MAX_DIMENSION = 1600  # Scans are shrunk to fit within this many pixels before OCR
+OCR_CONFIG = '--oem 1 --psm 6'  # LSTM engine only; treat the receipt as one uniform text block
+OCR_THRESHOLD = None  # Optional grayscale level (0-255) to binarize at; off because thin glyphs on small JPEGs break up
+USE_DETERMINISTIC_PARSER = True  # Skip the API for receipts the regex parser fully reconciles
+DETERMINISTIC_REQUIRED_FIELDS = ('store_name', 'store_address', 'date', 'fiscal_id')  # Header the regex parse must also fill
+PROMPT_VERSION = 7  # Bump when prompts, sampling or validation change to invalidate cached responses
+BATCH_POLL_SECONDS = 30  # How often to check on a Batch API job (--batch)
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+RECEIPTS_PER_REQUEST = 5  # Receipts packed into one chat completion (1 disables packing)
+PACK_WAIT_SECONDS = 0.5  # How long a partly filled pack waits for more receipts
+PACKED_MAX_TOKENS = 16000  # Output budget for a packed request (gpt-4o caps output at 16384)
+MAX_OUTPUT_TOKENS = 8000  # Output budget for one receipt when the estimate falls short
+HEADER_OUTPUT_TOKENS = 500  # Rough size of the receipt-level header object in the response
+OUTPUT_TOKENS_PER_ITEM = 60  # Rough size of one item object in the response
+VISION_IMAGE_TOKENS = 1105  # Prompt tokens for one high-detail receipt image (85 + 170 per tile, 6 tiles)
+VISION_MIME_TYPES = frozenset({'image/png', 'image/jpeg', 'image/webp', 'image/gif'})  # Others (e.g. TIFF) are sent as PNG
+FEEDBACK_RETRIES = 2  # Re-prompts with the problem described when a response yields no usable items
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv('openai'))
-
-# Thread-safe counter
-counter_lock = threading.Lock()
-processed_count = 0
-
-def extract_items_with_ai(ocr_text, filename, max_retries=2):
-    """
-    Improved AI extraction that focuses on extracting ALL items with realistic values.
-    """
-    
-    system_prompt = """You are an advanced AI specialist in Azerbaijani fiscal document processing with expertise in OCR error correction and retail transaction analysis.
+# Static extraction instructions, sent unchanged with every request so the
+# shared prefix can be served from OpenAI's prompt cache
+SYSTEM_PROMPT = """You are an advanced AI specialist in Azerbaijani fiscal document processing with expertise in OCR error correction and retail transaction analysis.
 
 MISSION: Extract ALL items from Azerbaijani receipt OCR text with maximum accuracy and intelligent error correction.
 
@@ -84,389 +127,1136 @@ QUALITY ASSURANCE:
 - All items from the receipt must be included
 - Prices must be realistic for Azerbaijan market
 
-CRITICAL REQUIREMENTS:
-1. Extract EVERY item from the receipt - most receipts have 2-15 items
-2. Look for the items section that starts with "Məhsulun adı Say Qiymət Cəmi" 
-3. Each item should have: name, quantity, unit_price, line_total
-4. Fix OCR errors in quantities - decimal places get misread:
-   - 1000 → 1.0 (OCR misreads "1.000" as "1000")
-   - 2000 → 2.0 (OCR misreads "2.000" as "2000")  
-   - 13000 → 1.0 (OCR error)
-   - Keep small realistic quantities (1-10 typical for most items)
-5. Fix prices to be realistic for Azerbaijan:
-   - Water: 0.5-1.5 AZN
-   - Bread/cookies: 0.5-3 AZN
-   - Drinks: 1-5 AZN
-   - If unit_price seems wrong, adjust to realistic value
-6. Ensure quantity × unit_price = line_total (fix calculation errors)
-7. Clean item names: remove ƏDV codes, quotes, prefixes like "*ƏDV", "ƏDV:", "vƏDV"
-8. Return ALL items found, not just the first one
-9. IMPORTANT: If you find 10+ items, include ALL of them in the response
-
-The receipt-level info should be the SAME for each item (store info, date, etc.)
+OUTPUT FORMAT:
+Return a JSON object with the receipt-level fields once in "header" and one object per item found in "items", as described in the response schema.
+
+EXAMPLES OF QUANTITY FIXES:
+- "Paket Araz 31\"60 5 K 1.000 0.05 0.05" → quantity: 1, unit_price: 0.05, line_total: 0.05
+- "SIRAB QAZSIZ SU PET 2.000 0.59 1.18" → quantity: 2, unit_price: 0.59, line_total: 1.18
+- "BIQ BON QOVYAD QRİL 1.000 2.10 2.10" → quantity: 1, unit_price: 2.10, line_total: 2.10
 """
-    
-    user_prompt = f"""Extract ALL items from this Azerbaijani receipt. Return a JSON array where each object has these 30 fields:
-
-RECEIPT: {filename}
-
-Required fields for each item:
-{{
-    "filename": "{filename}",
-    "store_name": "Store/business name (same for all items)",
-    "store_address": "Store address (same for all items)", 
-    "store_code": "Store code (same for all items)",
-    "taxpayer_name": "Taxpayer name (same for all items)",
-    "tax_id": "VOEN number (same for all items)",
-    "receipt_number": "Receipt number (same for all items)",
-    "cashier_name": "Cashier name (same for all items)",
-    "date": "DD.MM.YYYY (same for all items)",
-    "time": "HH:MM:SS (same for all items)",
+
+# What each field holds; sent as schema descriptions instead of a JSON template in the prompt
+FIELD_DESCRIPTIONS = {
+    "filename": "Receipt filename given after FILE:",
+    "store_name": "Store/business name",
+    "store_address": "Store address",
+    "store_code": "Store code",
+    "taxpayer_name": "Taxpayer name",
+    "tax_id": "VOEN number",
+    "receipt_number": "Receipt number",
+    "cashier_name": "Cashier name",
+    "date": "DD.MM.YYYY",
+    "time": "HH:MM:SS",
     "item_name": "Clean item name (NO ƏDV codes, quotes, or prefixes)",
     "quantity": "Realistic quantity (fix OCR errors: 1000→1, 2000→2, etc.)",
     "unit_price": "Realistic price per unit in AZN (fix if unrealistic)",
     "line_total": "quantity × unit_price (must be mathematically correct)",
-    "subtotal": "Receipt total (same for all items)",
-    "vat_18_percent": "VAT amount (same for all items)",
-    "total_tax": "Total tax (same for all items)",
-    "cashless_payment": "Cashless amount (same for all items)",
-    "cash_payment": "Cash amount (same for all items)", 
-    "bonus_payment": "Bonus amount (same for all items)",
-    "advance_payment": "Advance amount (same for all items)",
-    "credit_payment": "Credit amount (same for all items)",
-    "queue_number": "Queue number (same for all items)",
-    "cash_register_model": "Register model (same for all items)",
-    "cash_register_serial": "Register serial (same for all items)",
-    "fiscal_id": "Fiscal ID (same for all items)",
-    "fiscal_registration": "Fiscal registration (same for all items)",
-    "refund_amount": "Refund amount (same for all items)",
-    "refund_date": "Refund date (same for all items)",
-    "refund_time": "Refund time (same for all items)"
-}}
+    "subtotal": "Receipt total",
+    "vat_18_percent": "VAT amount",
+    "total_tax": "Total tax",
+    "cashless_payment": "Cashless amount",
+    "cash_payment": "Cash amount",
+    "bonus_payment": "Bonus amount",
+    "advance_payment": "Advance amount",
+    "credit_payment": "Credit amount",
+    "queue_number": "Queue number",
+    "cash_register_model": "Register model",
+    "cash_register_serial": "Register serial",
+    "fiscal_id": "Fiscal ID",
+    "fiscal_registration": "Fiscal registration",
+    "refund_amount": "Refund amount",
+    "refund_date": "Refund date",
+    "refund_time": "Refund time"
+}
 
-EXAMPLES OF QUANTITY FIXES:
-- "Paket Araz 31\"60 5 K 1.000 0.05 0.05" → quantity: 1, unit_price: 0.05, line_total: 0.05
-- "SIRAB QAZSIZ SU PET 2.000 0.59 1.18" → quantity: 2, unit_price: 0.59, line_total: 1.18
-- "BIQ BON QOVYAD QRİL 1.000 2.10 2.10" → quantity: 1, unit_price: 2.10, line_total: 2.10
+# Per-item fields; every other column is receipt-level and returned once in the header
+ITEM_FIELDS = ['item_name', 'quantity', 'unit_price', 'line_total']
+HEADER_FIELDS = [field for field in COLUMN_ORDER if field not in ITEM_FIELDS]
+
+# Fields formatted as 2-decimal AZN amounts
+MONETARY_FIELDS = ('unit_price', 'line_total', 'subtotal', 'vat_18_percent', 'total_tax',
+                   'cashless_payment', 'cash_payment', 'bonus_payment', 'advance_payment',
+                   'credit_payment', 'refund_amount')
+
+def _object_schema(fields):
+    """Strict structured-output object schema with a described property per field."""
+    return {
+        "type": "object",
+        "properties": {
+            field: {
+                "type": ["number", "null"] if field in ('quantity', 'unit_price', 'line_total') else ["string", "null"],
+                "description": FIELD_DESCRIPTIONS[field]
+            }
+            for field in fields
+        },
+        "required": fields,
+        "additionalProperties": False
+    }
+
+# Structured-output schema: receipt-level fields once in "header", plus one
+# small object per item; rows are joined back into COLUMN_ORDER afterwards
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "header": _object_schema(HEADER_FIELDS),
+        "items": {"type": "array", "items": _object_schema(ITEM_FIELDS)}
+    },
+    "required": ["header", "items"],
+    "additionalProperties": False
+}
+
+# Structured-output schema for packed requests: {"receipts": [one RESPONSE_SCHEMA object per file]}
+PACKED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "receipts": {"type": "array", "items": RESPONSE_SCHEMA}
+    },
+    "required": ["receipts"],
+    "additionalProperties": False
+}
+
+# Leads the user message of packed requests; kept out of SYSTEM_PROMPT so single
+# and packed requests share the same cached prompt prefix
+PACKED_INSTRUCTIONS = (
+    "Several receipts follow, each starting with its own FILE: line. Extract each receipt "
+    "independently and return one entry in \"receipts\" per file, with its filename in the header."
+)
+
+# Fields reported in the extraction summary
+SUMMARY_FIELDS = ['store_name', 'store_address', 'item_name', 'date']
+
+# Values the model returns for a field that is not on the receipt
+_MISSING = frozenset({None, '', 'null', 'None'})
+
+# Row written for a receipt nothing could be extracted from (see create_fallback_data)
+_FALLBACK_RECORD = {
+    **dict.fromkeys(COLUMN_ORDER),
+    **dict.fromkeys(('cashless_payment', 'cash_payment', 'bonus_payment', 'advance_payment', 'credit_payment'), "0.00")
+}
+
+# Initialize OpenAI clients; the SDK retries transient failures itself.
+# Real-time extraction uses the async client, the Batch API path the sync one,
+# which gets a longer timeout because each of its retries reuses the same limit.
+# The async client keeps up to MAX_WORKERS connections alive (HTTP/2 when h2 is
+# installed), so concurrent requests reuse open TLS connections.
+client = OpenAI(api_key=os.getenv('openai'), max_retries=API_MAX_RETRIES, timeout=BATCH_API_TIMEOUT)
+async_client = AsyncOpenAI(
+    api_key=os.getenv('openai'),
+    max_retries=API_MAX_RETRIES,
+    timeout=API_TIMEOUT,
+    http_client=DefaultAsyncHttpxClient(
+        http2=h2 is not None,
+        limits=httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS)
+    )
+)
+
+class RateLimiter:
+    """
+    Token-bucket throttle for OpenAI requests-per-minute and tokens-per-minute limits.
+    
+    Each request waits until both buckets hold enough capacity instead of firing
+    into a 429 and backing off. Capacity refills continuously at the configured
+    per-minute rates; a rate-limit error halves what is left so the limiter
+    falls in step with the server.
+    """
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.max_requests = requests_per_minute
+        self.max_tokens = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_requests = min(self.max_requests, self.available_requests + self.max_requests * elapsed / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + self.max_tokens * elapsed / 60)
+    
+    async def acquire(self, tokens):
+        """Wait until one request and the given number of tokens are available, then consume them."""
+        tokens = min(tokens, self.max_tokens)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.max_requests,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens
+                )
+                await asyncio.sleep(wait)
+    
+    def penalize(self):
+        """Halve the remaining capacity after the server reports a rate limit."""
+        self.available_requests /= 2
+        self.available_tokens /= 2
+    
+    def observe(self, headers):
+        """
+        Clamp local capacity to what the server reports is left.
+        
+        The x-ratelimit-remaining-* headers also count other clients on the same
+        key and 429s the SDK retried internally, which the local buckets never see.
+        """
+        self._refill()
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        if remaining_requests is not None:
+            self.available_requests = min(self.available_requests, float(remaining_requests))
+        if remaining_tokens is not None:
+            self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+
+rate_limiter = RateLimiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
 
-OCR TEXT:
-{ocr_text}
+# Per-process tesserocr handle, created by _init_ocr_worker (or on first use) so
+# each OCR worker loads the language model once instead of once per image
+_tess_api = None
 
-Return ONLY a valid JSON array with one object per item found."""
+def _read_cache(path):
+    """Return the cached text stored at path, or None on a cache miss."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _write_cache(path, text):
+    """Write text to the cache atomically so a crash never leaves a partial entry."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def preprocess_image(image):
+    """
+    Prepare a receipt image for Tesseract: grayscale, shrink oversized scans, stretch contrast.
     
-    for attempt in range(max_retries):
+    Tesseract runtime grows with pixel count, so this cuts OCR time without losing
+    legibility. Binarization is left to Tesseract's own adaptive thresholding
+    unless OCR_THRESHOLD is set.
+    """
+    image = ImageOps.autocontrast(image.convert('L'))
+    image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)  # No-op for smaller images
+    if OCR_THRESHOLD is not None:
+        image = image.point(lambda p: 255 if p > OCR_THRESHOLD else 0, mode='1')
+    return image
+
+def ocr_image(image):
+    """
+    Run Tesseract on a preprocessed image.
+    
+    Uses tesserocr in-process when it is installed, avoiding a tesseract
+    subprocess and model load per image; otherwise falls back to pytesseract.
+    """
+    global _tess_api
+    
+    if PyTessBaseAPI is None:
+        return pytesseract.image_to_string(image, lang=OCR_LANG, config=OCR_CONFIG)
+    
+    if _tess_api is None:
+        # Same settings as OCR_CONFIG
+        _tess_api = PyTessBaseAPI(lang=OCR_LANG, oem=OEM.LSTM_ONLY, psm=PSM.SINGLE_BLOCK)
+    _tess_api.SetImage(image)
+    return _tess_api.GetUTF8Text()
+
+def _init_ocr_worker():
+    """
+    Warm up Tesseract when an OCR worker process starts.
+    
+    Running a blank image through ocr_image loads the language model (and the
+    tesserocr handle, when available) before the first real receipt arrives,
+    so the first OCR in each worker is as fast as the rest.
+    """
+    try:
+        ocr_image(Image.new('L', (10, 10), 255))
+    except Exception as e:
+        logger.warning(f"Tesseract warm-up failed: {e}")
+
+def get_ocr(filepath):
+    """
+    Return the OCR text for a receipt image, running Tesseract only on a cache miss.
+    
+    Cache entries are keyed by the image content, the OCR language and OCR_VERSION,
+    so re-runs over unchanged images skip Tesseract entirely.
+    """
+    with open(filepath, 'rb') as f:
+        image_bytes = f.read()
+    
+    key = hashlib.sha1(image_bytes + f"|{OCR_LANG}|{OCR_VERSION}".encode('utf-8')).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, 'ocr', f"{key}.txt")
+    
+    text = _read_cache(cache_path)
+    if text is None:
+        text = ocr_image(preprocess_image(Image.open(io.BytesIO(image_bytes))))
+        _write_cache(cache_path, text)
+    return text
+
+def estimate_output_tokens(ocr_text):
+    """
+    Estimate the output budget for one receipt from its OCR text.
+    
+    Item rows make up roughly a third of a receipt's lines. Reserving only what
+    the receipt needs keeps TPM headroom for other requests; a response cut off
+    at the estimate is retried with MAX_OUTPUT_TOKENS.
+    """
+    estimated_items = max(2, min(20, ocr_text.count('\n') // 3))
+    return min(MAX_OUTPUT_TOKENS, HEADER_OUTPUT_TOKENS + OUTPUT_TOKENS_PER_ITEM * estimated_items)
+
+def build_chat_request(ocr_text, filename):
+    """
+    Build the chat completion payload for one receipt.
+    
+    Shared by the real-time path and the Batch API path so both send identical
+    requests. All static instructions live in SYSTEM_PROMPT, so the per-receipt
+    user message is just the filename and OCR text.
+    """
+    
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"FILE: {filename}\nOCR:\n{ocr_text}"}
+        ],
+        "temperature": 0,  # Greedy decoding: repeatable output, no sampling detours
+        "max_tokens": estimate_output_tokens(ocr_text),
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "receipt_items", "strict": True, "schema": RESPONSE_SCHEMA}
+        },
+    }
+
+def build_vision_request(image_bytes, filename):
+    """
+    Build the chat completion payload for one receipt image (--vision mode).
+    
+    Same system prompt and schema as build_chat_request, with the image in
+    place of the OCR text. There is no text to size the output from, so the
+    budget covers the 20-item upper bound used by estimate_output_tokens.
+    Formats the vision endpoint does not accept are converted to PNG first.
+    """
+    
+    mime_type = mimetypes.guess_type(filename)[0] or 'image/jpeg'
+    if mime_type not in VISION_MIME_TYPES:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                image = image.convert('RGB')  # e.g. CMYK or 16-bit scans, which PNG cannot store
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+        image_bytes, mime_type = buffer.getvalue(), 'image/png'
+    image_url = f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": [
+                {"type": "text", "text": f"FILE: {filename}\nNo OCR text: read the attached receipt image directly."},
+                {"type": "image_url", "image_url": {"url": image_url, "detail": "high"}}
+            ]}
+        ],
+        "temperature": 0,
+        "max_tokens": HEADER_OUTPUT_TOKENS + OUTPUT_TOKENS_PER_ITEM * 20,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "receipt_items", "strict": True, "schema": RESPONSE_SCHEMA}
+        },
+    }
+
+def build_packed_chat_request(ocr_texts):
+    """
+    Build one chat completion payload covering several receipts.
+    
+    Each receipt keeps the FILE/OCR layout used by build_chat_request, so the
+    model sees the same per-receipt input whether or not it is packed.
+    """
+    
+    receipts = "\n\n".join(f"FILE: {filename}\nOCR:\n{ocr_text}" for filename, ocr_text in ocr_texts.items())
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"{PACKED_INSTRUCTIONS}\n\n{receipts}"}
+        ],
+        "temperature": 0,
+        "max_tokens": min(PACKED_MAX_TOKENS, sum(map(estimate_output_tokens, ocr_texts.values()))),
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "packed_receipt_items", "strict": True, "schema": PACKED_RESPONSE_SCHEMA}
+        },
+    }
+
+# Tokenizer for the TPM estimate, loaded once; models tiktoken doesn't know yet use the GPT-4o encoding
+_encoding = None
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.encoding_for_model(MODEL)
+    except KeyError:
+        _encoding = tiktoken.get_encoding('o200k_base')
+
+def estimate_request_tokens(request):
+    """Estimate how many tokens a chat request counts against the TPM limit (prompt plus max_tokens)."""
+    text = ""
+    images = 0
+    for message in request['messages']:
+        if isinstance(message['content'], str):
+            text += message['content']
+            continue
+        for part in message['content']:  # Vision requests mix text and image parts
+            if part['type'] == 'text':
+                text += part['text']
+            else:
+                images += 1
+    
+    if _encoding is not None:
+        prompt_tokens = len(_encoding.encode(text))
+    else:
+        prompt_tokens = len(text) // 3  # Azerbaijani text averages under 3 characters per token
+    return prompt_tokens + images * VISION_IMAGE_TOKENS + request['max_tokens']
+
+def log_usage(response, label):
+    """Log a response's token usage, including how much of the prompt hit OpenAI's prefix cache."""
+    usage = response.usage
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', None) or 0
+    logger.info(f"Tokens for {label}: {usage.prompt_tokens} prompt ({cached_tokens} cached), "
+                f"{usage.completion_tokens} completion")
+
+def join_receipt(receipt, filename):
+    """
+    Denormalize a {"header", "items"} receipt into one COLUMN_ORDER row per item.
+    """
+    header = {**receipt['header'], 'filename': filename}
+    return [{**header, **item} for item in receipt['items'] if isinstance(item, dict)]
+
+def parse_ai_response(ai_response, filename):
+    """
+    Parse a structured-output model response into a list of validated items.
+    
+    Raises:
+        json.JSONDecodeError: If the response is not valid JSON.
+    """
+    extracted_items = join_receipt(json_loads(ai_response), filename)
+    return validate_and_clean_items(extracted_items, filename)
+
+def request_timeout(request):
+    """
+    Return the timeout for a chat request, sized to its output budget.
+    
+    Non-streaming responses arrive only once generation finishes, so a fixed
+    timeout is either too long for small receipts or too short for large ones.
+    """
+    return API_TIMEOUT + request['max_tokens'] / API_TOKENS_PER_SECOND
+
+async def send_completion(request, label):
+    """
+    Send a chat request on SERVICE_TIER, if one is configured, once the rate limiter allows it.
+    
+    Discounted tiers such as flex queue requests, so that attempt gets
+    SERVICE_TIER_TIMEOUT, and reject them with a 429 when capacity is short.
+    It is made without SDK retries; a request that times out or is rejected
+    there is re-sent on the default tier after acquiring capacity again. The
+    rate-limit headers of the response are fed back into rate_limiter.
+    """
+    create = async_client.chat.completions.with_raw_response.create
+    tokens = estimate_request_tokens(request)
+    raw_response = None
+    if SERVICE_TIER:
+        await rate_limiter.acquire(tokens)
+        tier_create = async_client.with_options(max_retries=0).chat.completions.with_raw_response.create
         try:
-            # Reduced logging for speed
-            if attempt > 0:
-                logger.info(f"Retry {attempt + 1}/{max_retries} for {filename}")
-            
-            response = client.chat.completions.create(
-                model="gpt-4o",  # Upgraded to more advanced model
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.05,  # Even more deterministic
-                max_tokens=8000,   # Increased for better extraction
-                timeout=30.0  # Optimized timeout for speed
-            )
-            
-            ai_response = response.choices[0].message.content.strip()
-            # Reduced verbose logging for speed
-            
-            # Remove code block markers if present
-            if ai_response.startswith('```json'):
-                ai_response = ai_response.replace('```json', '').replace('```', '').strip()
-            elif ai_response.startswith('```'):
-                ai_response = ai_response.replace('```', '').strip()
-            
-            # Clean up common JSON formatting issues
-            ai_response = ai_response.strip()
-            if not ai_response.startswith('['):
-                # If response doesn't start with array, try to find JSON array in response
-                import re
-                json_match = re.search(r'\[.*\]', ai_response, re.DOTALL)
-                if json_match:
-                    ai_response = json_match.group(0)
-                else:
-                    logger.error(f"No JSON array found in response for {filename}")
-                    if attempt < max_retries - 1:
-                        time.sleep(2 ** attempt)
-                        continue
-                    else:
-                        return []
-            
-            # Parse JSON
-            extracted_items = json.loads(ai_response)
-            
-            # Ensure it's a list
-            if not isinstance(extracted_items, list):
-                extracted_items = [extracted_items]
-            
-            # Validate and clean each item
-            validated_items = []
-            for item in extracted_items:
-                validated_item = validate_and_clean_item(item)
-                if validated_item:
-                    validated_items.append(validated_item)
-            
-            if not validated_items:
-                logger.warning(f"No valid items extracted from {filename}")
-                # If no items and we have retries left, continue to next attempt
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-                    continue
-                else:
-                    return []
-            
-            logger.info(f"Successfully extracted {len(validated_items)} items from {filename}")
-            return validated_items
+            raw_response = await tier_create(**request, service_tier=SERVICE_TIER, timeout=SERVICE_TIER_TIMEOUT)
+        except APITimeoutError:
+            logger.warning(f"{SERVICE_TIER} tier timed out for {label}, retrying on the default tier")
+        except RateLimitError:
+            logger.warning(f"{SERVICE_TIER} tier has no capacity for {label}, retrying on the default tier")
+    if raw_response is None:
+        await rate_limiter.acquire(tokens)
+        raw_response = await create(**request, timeout=request_timeout(request))
+    
+    rate_limiter.observe(raw_response.headers)
+    return raw_response.parse()
+
+async def create_completion(request, label, max_output_tokens=MAX_OUTPUT_TOKENS):
+    """
+    Send a chat request through send_completion and log its token usage.
+    
+    A response cut off at an estimated max_tokens below max_output_tokens is
+    re-sent once with max_output_tokens, the ceiling for this kind of request.
+    """
+    response = await send_completion(request, label)
+    log_usage(response, label)
+    
+    if response.choices[0].finish_reason == 'length' and request['max_tokens'] < max_output_tokens:
+        logger.info(f"Response for {label} hit the {request['max_tokens']}-token estimate, retrying with {max_output_tokens}")
+        request['max_tokens'] = max_output_tokens
+        response = await send_completion(request, label)
+        log_usage(response, label)
+    return response
+
+async def extract_items_with_ai(ocr_text, filename):
+    """
+    Improved AI extraction that focuses on extracting ALL items with realistic values.
+    """
+    return await complete_receipt(build_chat_request(ocr_text, filename), filename)
+
+async def complete_receipt(request, filename):
+    """
+    Send a single-receipt chat request and return its validated items.
+    
+    Requests are paced by rate_limiter so they rarely hit a 429. Connection errors,
+    timeouts, 429s and 5xx responses are retried by the OpenAI client itself with
+    jittered backoff that honours Retry-After, so there is no application-level
+    retry loop. Two cases are re-sent here: a response cut off at the estimated
+    max_tokens (see create_completion), and a response that is not valid JSON or
+    yields no usable items, which is retried up to FEEDBACK_RETRIES times with the
+    problem described back to the model.
+    """
+    
+    validated_items = []
+    
+    try:
+        for attempt in range(FEEDBACK_RETRIES + 1):
+            response = await create_completion(request, filename)
+            message = response.choices[0].message
+            if message.refusal:
+                # Structured outputs report refusals here, with no content to parse
+                logger.warning(f"Model refused {filename}: {message.refusal}")
+                return []
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parsing error for {filename} (attempt {attempt + 1}): {e}")
-            logger.error(f"Response was: {ai_response[:500] if 'ai_response' in locals() else 'No response'}")
-            # Try to recover with fallback parsing
-            fallback_result = try_fallback_parsing(ai_response if 'ai_response' in locals() else "", filename)
-            if fallback_result:
-                return fallback_result
-            # If fallback failed and we have retries left, continue to next attempt
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-                continue
+            try:
+                validated_items = parse_ai_response(message.content, filename)
+            except json.JSONDecodeError as e:
+                # Structured outputs make this rare (e.g. a truncated response)
+                logger.error(f"JSON parsing error for {filename}: {e}")
+                feedback = f"Your previous output was not valid JSON ({e}). Return the complete JSON object again."
             else:
-                return []
+                if validated_items:
+                    break
+                feedback = ("None of the items in your previous output had an item_name, quantity, unit_price "
+                            "and line_total. Re-read the items section and return every item with all four.")
+            
+            if attempt < FEEDBACK_RETRIES:
+                logger.info(f"Retrying {filename} with feedback ({attempt + 1}/{FEEDBACK_RETRIES})")
+                request['messages'] = request['messages'] + [
+                    {"role": "assistant", "content": message.content},
+                    {"role": "user", "content": feedback}
+                ]
+    except RateLimitError as e:
+        rate_limiter.penalize()
+        logger.error(f"Rate limited on {filename} after retries: {e}")
+        return []
+    except Exception as e:
+        logger.error(f"AI extraction error for {filename}: {e}")
+        return []
+    
+    if not validated_items:
+        logger.warning(f"No valid items extracted from {filename}")
+        return []
+    
+    logger.info(f"Successfully extracted {len(validated_items)} items from {filename}")
+    return validated_items
+
+async def extract_items_packed(ocr_texts):
+    """
+    Extract items for several receipts with a single chat completion.
+    
+    Args:
+        ocr_texts (dict): Mapping of filename to OCR text.
         
+    Returns:
+        dict: Mapping of filename to validated items. Receipts the response
+        missed or returned without items are left out so the caller can retry them.
+    """
+    
+    request = build_packed_chat_request(ocr_texts)
+    
+    try:
+        response = await create_completion(request, f"a pack of {len(ocr_texts)} receipts", PACKED_MAX_TOKENS)
+        message = response.choices[0].message
+        if message.refusal:
+            logger.warning(f"Model refused a pack of {len(ocr_texts)} receipts: {message.refusal}")
+            return {}
+        receipts = json_loads(message.content)["receipts"]
+    except RateLimitError as e:
+        rate_limiter.penalize()
+        logger.error(f"Rate limited on a pack of {len(ocr_texts)} receipts after retries: {e}")
+        return {}
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON parsing error for a pack of {len(ocr_texts)} receipts: {e}")
+        return {}
+    except Exception as e:
+        logger.error(f"AI extraction error for a pack of {len(ocr_texts)} receipts: {e}")
+        return {}
+    
+    results = {}
+    for receipt in receipts:
+        filename = receipt['header']['filename']
+        if filename in ocr_texts and filename not in results:
+            items = validate_and_clean_items(join_receipt(receipt, filename), filename)
+            if items:
+                results[filename] = items
+    
+    logger.info(f"Packed request covered {len(results)}/{len(ocr_texts)} receipts")
+    return results
+
+class ReceiptPacker:
+    """
+    Groups concurrent extraction calls into packed chat completions.
+    
+    Receipts arriving within PACK_WAIT_SECONDS of each other share one request,
+    up to RECEIPTS_PER_REQUEST at a time, so the system prompt is sent once per
+    pack instead of once per receipt. Receipts a packed response misses are
+    retried on their own with extract_items_with_ai.
+    """
+    
+    def __init__(self, size, wait_seconds):
+        self.size = size
+        self.wait_seconds = wait_seconds
+        self.pending = []  # (filename, ocr_text, future) waiting for the next flush
+        self.flush_handle = None
+        self._tasks = set()  # Running packs; the event loop only keeps weak references to tasks
+    
+    async def extract(self, ocr_text, filename):
+        """Return validated items for one receipt, sharing a request with other pending receipts."""
+        if self.size <= 1:
+            return await extract_items_with_ai(ocr_text, filename)
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((filename, ocr_text, future))
+        if len(self.pending) >= self.size:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.wait_seconds, self._flush)
+        return await future
+    
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pack, self.pending = self.pending, []
+        if pack:
+            task = asyncio.ensure_future(self._run(pack))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, pack):
+        try:
+            results = {}
+            if len(pack) > 1:
+                results = await extract_items_packed({filename: ocr_text for filename, ocr_text, _ in pack})
+            
+            missed = [(filename, ocr_text) for filename, ocr_text, _ in pack if filename not in results]
+            retried = await asyncio.gather(*(extract_items_with_ai(ocr_text, filename) for filename, ocr_text in missed))
+            results.update((filename, items) for (filename, _), items in zip(missed, retried))
         except Exception as e:
-            logger.error(f"AI extraction error for {filename} (attempt {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-                continue
-            else:
-                return []
+            for _, _, future in pack:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for filename, _, future in pack:
+            future.set_result(results[filename])
+
+receipt_packer = ReceiptPacker(RECEIPTS_PER_REQUEST, PACK_WAIT_SECONDS)
+
+def ocr_text_key(ocr_text):
+    """
+    Return a stable hash of OCR text with whitespace runs collapsed.
     
-    return []
+    Re-OCRing a receipt often changes only spacing and blank lines; those
+    variants share one key, so they share one API call and one cache entry.
+    """
+    return hashlib.sha256(_WS_RE.sub(' ', ocr_text).strip().encode('utf-8')).hexdigest()
 
-def try_fallback_parsing(ai_response, filename):
+def _ai_cache_path(ocr_text):
     """
-    Try to extract items from malformed AI response using regex fallback.
+    Return the cache file for an AI response.
+    
+    The key covers the model, SYSTEM_PROMPT itself and PROMPT_VERSION (for schema,
+    sampling and validation changes), so any prompt edit invalidates old responses.
     """
+    key = hashlib.sha256(f"{MODEL}|{PROMPT_VERSION}|{SYSTEM_PROMPT}|{ocr_text_key(ocr_text)}".encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, 'ai', f"{key}.json")
+
+def relabel_items(items, filename):
+    """Return copies of items with their filename set, for reusing one response across files."""
+    return [{**item, 'filename': filename} for item in items]
+
+def load_cached_items(ocr_text, filename):
+    """Return cached items for this OCR text re-labelled with filename, or None on a miss."""
+    cached = _read_cache(_ai_cache_path(ocr_text))
+    if cached is None:
+        return None
+    
+    logger.info(f"Using cached AI response for {filename}")
+    return relabel_items(json_loads(cached), filename)
+
+def store_cached_items(ocr_text, items):
+    """Persist validated items for this OCR text."""
+    _write_cache(_ai_cache_path(ocr_text), json.dumps(items, ensure_ascii=False))
+
+def parse_with_regexes(ocr_text, filename):
+    """Run the traditional regex parser (parse.py) on OCR text, returning [] if it fails."""
+    try:
+        return parse_receipt_text(ocr_text, filename)
+    except Exception as e:
+        logger.error(f"Regex parser failed for {filename}: {e}")
+        return []
+
+def extract_items_deterministic(records, filename):
+    """
+    Use a receipt's regex parse (see parse_with_regexes) instead of an API call.
+    
+    The result is only trusted when it is internally consistent: every line has
+    quantity × unit_price = line_total, the line totals add up to the printed
+    subtotal, and every DETERMINISTIC_REQUIRED_FIELDS header field was found.
+    Anything else returns None so the receipt goes to the model.
+    """
+    if not USE_DETERMINISTIC_PARSER:
+        return None
+    
+    if not records or 'error' in records[0] or not records[0].get('subtotal'):
+        return None
+    if any(records[0].get(field) in _MISSING for field in DETERMINISTIC_REQUIRED_FIELDS):
+        return None  # Items reconcile but the header is incomplete; the model fills it in
+    
     try:
-        # Try to find individual JSON objects in the response
-        import re
+        subtotal = float(records[0]['subtotal'])
+    except ValueError:
+        return None
+    
+    for record in records:
+        if abs(record['quantity'] * record['unit_price'] - record['line_total']) > 0.01:
+            return None
+    if abs(sum(record['line_total'] for record in records) - subtotal) > 0.01:
+        return None
+    
+    logger.info(f"Parsed {filename} without AI: {len(records)} items reconcile with subtotal {subtotal:.2f}")
+    return validate_and_clean_items(records, filename)
+
+async def extract_items_cached(ocr_text, filename, records):
+    """
+    Cached wrapper around AI extraction.
+    
+    Receipts whose regex parse (records) fully reconciles skip the API. Re-runs
+    over unchanged receipts do not repeat the GPT-4o call; cache misses go
+    through receipt_packer so concurrent misses share packed requests.
+    """
+    items = extract_items_deterministic(records, filename)
+    if items:
+        return items
+    
+    items = load_cached_items(ocr_text, filename)
+    if items is not None:
+        return items
+    
+    items = await receipt_packer.extract(ocr_text, filename)
+    if items:
+        store_cached_items(ocr_text, items)
+    return items
+
+async def extract_items_from_image(filepath, filename):
+    """
+    Extract items by sending the receipt image itself to the model (--vision).
+    
+    Skips Tesseract and the deterministic parser. Results are cached under a
+    hash of the image bytes, the way OCR-based results are cached by OCR text.
+    """
+    with open(filepath, 'rb') as f:
+        image_bytes = f.read()
+    
+    image_key = f"IMAGE {hashlib.sha256(image_bytes).hexdigest()}"
+    items = load_cached_items(image_key, filename)
+    if items is None:
+        items = await complete_receipt(build_vision_request(image_bytes, filename), filename)
+        if items:
+            store_cached_items(image_key, items)
+    return items
+
+def run_batch_extraction(ocr_texts):
+    """
+    Extract items for many receipts with a single OpenAI Batch API job.
+    
+    The Batch API is billed at half the real-time price and has no per-call
+    round trip, at the cost of results arriving within the completion window
+    rather than immediately.
+    
+    Args:
+        ocr_texts (dict): Mapping of filename to OCR text.
         
-        # Look for JSON-like objects
-        object_pattern = r'\{[^{}]*"item_name"[^{}]*\}'
-        objects = re.findall(object_pattern, ai_response)
+    Returns:
+        dict: Mapping of filename to validated items for every receipt that succeeded.
+    """
+    
+    lines = []
+    for filename, ocr_text in ocr_texts.items():
+        lines.append(json.dumps({
+            "custom_id": filename,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_chat_request(ocr_text, filename)
+        }, ensure_ascii=False))
+    
+    batch_input = client.files.create(
+        file=("receipts_batch.jsonl", "\n".join(lines).encode('utf-8')),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    logger.info(f"📦 Submitted batch {batch.id} with {len(lines)} receipts")
+    
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        if counts:
+            logger.info(f"Batch {batch.id}: {batch.status} ({counts.completed}/{counts.total} done, {counts.failed} failed)")
+        else:
+            logger.info(f"Batch {batch.id}: {batch.status}")
+    
+    if not batch.output_file_id:
+        logger.error(f"Batch {batch.id} finished with status '{batch.status}' and no output")
+        return {}
+    
+    results = {}
+    output = client.files.content(batch.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
         
-        extracted_items = []
-        for obj_str in objects:
-            try:
-                # Try to parse individual object
-                obj = json.loads(obj_str)
-                extracted_items.append(obj)
-            except:
-                continue
+        record = json_loads(line)
+        filename = record['custom_id']
+        response = record.get('response') or {}
+        if response.get('status_code') != 200:
+            logger.error(f"Batch request failed for {filename}: {record.get('error') or response.get('status_code')}")
+            continue
         
-        if extracted_items:
-            logger.info(f"Fallback parsing recovered {len(extracted_items)} items from {filename}")
-            return [validate_and_clean_item(item) for item in extracted_items if validate_and_clean_item(item)]
+        message = response['body']['choices'][0]['message']
+        if message.get('refusal'):
+            logger.warning(f"Model refused {filename}: {message['refusal']}")
+            continue
         
-    except Exception as e:
-        logger.error(f"Fallback parsing failed for {filename}: {e}")
+        try:
+            items = parse_ai_response(message['content'], filename)
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON parsing error for {filename}: {e}")
+            continue
+        
+        if items:
+            results[filename] = items
     
-    return []
+    return results
 
-def validate_and_clean_item(item):
+def _to_number(value):
+    """Return value as a number, or None if it is missing or not numeric."""
+    if value is None or isinstance(value, bool):
+        return None
+    if not isinstance(value, (int, float)):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+    return value if value == value else None  # NaN counts as missing
+
+def validate_and_clean_items(extracted_items, filename):
     """
-    Validate and clean individual item data.
+    Validate and clean all items of one receipt.
+    
+    Args:
+        extracted_items (list): Item dictionaries parsed from the AI response.
+        filename (str): Receipt filename, used for logging.
+        
+    Returns:
+        list: Cleaned item dictionaries. Items without a name or without
+              numeric quantity, unit price and line total are dropped.
     """
     
+    cleaned_items = []
+    dropped = ocr_fixes = quantity_fixes = total_fixes = 0
     
-    try:
+    for item in extracted_items:
         # Ensure required fields exist
-        if not item.get('item_name') or item['item_name'] in [None, "null", "", "N/A"]:
-            return None
-        
-        # Validate that we have basic numeric fields
-        required_numeric_fields = ['quantity', 'unit_price', 'line_total']
-        for field in required_numeric_fields:
-            if item.get(field) is None or item[field] in ["null", "", "N/A"]:
-                logger.warning(f"Missing required field {field} for item {item.get('item_name', 'unknown')}")
-                return None
-        
-        # Validate and fix mathematical calculations
-        if all(item.get(field) not in [None, "null", ""] for field in ['quantity', 'unit_price', 'line_total']):
-            quantity = float(item['quantity'])
-            unit_price = float(item['unit_price'])
-            line_total = float(item['line_total'])
-            
-            # Fix OCR errors in quantities (1000 → 1.0, 2000 → 2.0, etc.)
-            if quantity >= 1000:
-                # OCR often misreads decimal points as "000"
-                quantity = round(quantity / 1000, 1)
-                item['quantity'] = str(quantity)
-                logger.info(f"Fixed OCR quantity error for {item.get('item_name', 'unknown')}: {float(item['quantity']) * 1000:.0f} → {quantity}")
-            
-            # Fix calculation if incorrect
-            expected_total = quantity * unit_price
-            if abs(line_total - expected_total) > 0.01:
-                # If quantity × unit_price doesn't match line_total, try to fix quantity
-                if unit_price > 0:
-                    corrected_quantity = round(line_total / unit_price, 1)
-                    if corrected_quantity > 0 and corrected_quantity <= 100:  # Reasonable quantity
-                        item['quantity'] = str(corrected_quantity)
-                        logger.info(f"Fixed quantity for {item.get('item_name', 'unknown')}: {quantity} → {corrected_quantity} (to match line_total)")
-                        quantity = corrected_quantity
-                    else:
-                        # Fix line_total instead
-                        item['line_total'] = f"{expected_total:.2f}"
-                        logger.info(f"Fixed calculation for {item.get('item_name', 'unknown')}: {quantity} × {unit_price} = {expected_total:.2f}")
-                else:
-                    item['line_total'] = f"{expected_total:.2f}"
+        if not isinstance(item, dict) or item.get('item_name') in _MISSING or item['item_name'] == "N/A":
+            continue
         
-        # Validate realistic quantities (flag suspicious values)
-        if item.get('quantity') and item['quantity'] not in [None, "null", ""]:
-            quantity = float(item['quantity'])
-            if quantity > 50:
-                logger.warning(f"Suspicious quantity for {item.get('item_name', 'unknown')}: {quantity}")
+        # Validate that we have basic numeric fields; unparseable values are treated as missing
+        quantity = _to_number(item.get('quantity'))
+        unit_price = _to_number(item.get('unit_price'))
+        line_total = _to_number(item.get('line_total'))
+        if quantity is None or unit_price is None or line_total is None:
+            dropped += 1
+            continue
         
-        # Validate realistic prices for Azerbaijan market
-        if item.get('unit_price') and item['unit_price'] not in [None, "null", ""]:
-            unit_price = float(item['unit_price'])
-            if unit_price > 500:  # Very expensive item
-                logger.warning(f"High price for {item.get('item_name', 'unknown')}: {unit_price} AZN")
+        # Fix OCR errors in quantities (1000 → 1.0, 2000 → 2.0, etc.)
+        if quantity >= 1000:
+            quantity = round(quantity / 1000, 1)
+            ocr_fixes += 1
         
-        # Format monetary values
-        monetary_fields = ['unit_price', 'line_total', 'subtotal', 'vat_18_percent', 'total_tax',
-                          'cashless_payment', 'cash_payment', 'bonus_payment', 'advance_payment',
-                          'credit_payment', 'refund_amount']
+        # Fix calculation if incorrect: prefer a reasonable quantity that matches
+        # line_total, otherwise recompute line_total from quantity × unit_price
+        expected_total = quantity * unit_price
+        if abs(line_total - expected_total) > 0.01:
+            corrected_quantity = round(line_total / unit_price, 1) if unit_price > 0 else 0
+            if 0 < corrected_quantity <= 100:
+                quantity = corrected_quantity
+                quantity_fixes += 1
+            else:
+                line_total = expected_total
+                total_fixes += 1
         
-        for field in monetary_fields:
-            if item.get(field) and item[field] not in [None, "null", ""]:
-                try:
-                    value = float(item[field])
-                    item[field] = f"{value:.2f}"
-                except (ValueError, TypeError):
-                    item[field] = "0.00"
+        # Flag suspicious quantities and unrealistic prices for Azerbaijan market
+        if quantity > 50:
+            logger.warning(f"Suspicious quantity for {item['item_name']}: {quantity}")
+        if unit_price > 500:
+            logger.warning(f"High price for {item['item_name']}: {unit_price} AZN")
         
-        # Clean item names
-        if item.get('item_name'):
-            item_name = item['item_name']
-            # Remove VAT codes and prefixes
-            item_name = re.sub(r'^v?ƏDV[:\s]*\d+[:\s]*', '', item_name)
-            item_name = re.sub(r'^"?ƏDV[:\s]*\d+[:\s]*', '', item_name)
-            item_name = re.sub(r'^ƏDV-dən\s+azad\s+', '', item_name)
-            item_name = re.sub(r'^Ticarət\s+əlavəsi[:\s]*\d*\s*', '', item_name)
-            item_name = re.sub(r'^["\']+|["\']+$', '', item_name)
-            item_name = re.sub(r'\s+', ' ', item_name).strip()
-            item['item_name'] = item_name
+        cleaned = {**item, 'quantity': quantity, 'line_total': line_total}
         
-        return item
+        # Format monetary values as 2-decimal strings; unparseable values become "0.00"
+        for field in MONETARY_FIELDS:
+            if cleaned.get(field) not in _MISSING:
+                value = _to_number(cleaned[field])
+                cleaned[field] = f"{value:.2f}" if value is not None else "0.00"
         
-    except Exception as e:
-        logger.error(f"Error validating item: {e}")
-        return None
+        cleaned['item_name'] = clean_item_name(str(item['item_name']))
+        cleaned_items.append(cleaned)
+    
+    if dropped:
+        logger.warning(f"Dropped {dropped} items with missing quantity/price/total from {filename}")
+    if ocr_fixes:
+        logger.info(f"Fixed {ocr_fixes} OCR quantity errors in {filename}")
+    if quantity_fixes or total_fixes:
+        logger.info(f"Fixed {quantity_fixes} quantities and {total_fixes} line totals in {filename}")
+    
+    return cleaned_items
 
-def create_fallback_data(filename):
-    """
-    Create fallback data structure when AI extraction fails.
-    """
-    
-    return [{
-        'filename': filename,
-        'store_name': None,
-        'store_address': None,
-        'store_code': None,
-        'taxpayer_name': None,
-        'tax_id': None,
-        'receipt_number': None,
-        'cashier_name': None,
-        'date': None,
-        'time': None,
-        'item_name': None,
-        'quantity': None,
-        'unit_price': None,
-        'line_total': None,
-        'subtotal': None,
-        'vat_18_percent': None,
-        'total_tax': None,
-        'cashless_payment': "0.00",
-        'cash_payment': "0.00",
-        'bonus_payment': "0.00",
-        'advance_payment': "0.00",
-        'credit_payment': "0.00",
-        'queue_number': None,
-        'cash_register_model': None,
-        'cash_register_serial': None,
-        'fiscal_id': None,
-        'fiscal_registration': None,
-        'refund_amount': None,
-        'refund_date': None,
-        'refund_time': None,
-        'error': 'AI extraction failed'
-    }]
-
-def process_receipt_with_ai(filepath, filename):
-    """
-    Process a single receipt using improved AI extraction.
-    """
-    
-    global processed_count
+def create_fallback_data(filename, records=None, error='AI extraction failed'):
+    """
+    Create fallback data structure when extraction fails.
+    
+    When the receipt's regex parse is available, the receipt-level fields it
+    found (store, tax ID, date, totals, ...) are kept instead of left empty.
+    The item columns stay empty; error is kept on the record (not written to
+    the CSV) so the summary can count the receipt as failed.
+    """
+    
+    logger.warning(f"{error} for {filename}, writing a fallback row")
+    record = dict(_FALLBACK_RECORD, filename=filename, error=error)
+    if records:
+        header = records[0]
+        record.update({field: header[field] for field in HEADER_FIELDS if header.get(field) not in _MISSING})
+    return [record]
+
+def append_receipt_to_csv(writer, records, stats):
+    """
+    Write one receipt's records through the output CSV writer and update the running summary counters.
+    
+    Writing each receipt as soon as it completes keeps memory flat regardless of
+    corpus size and leaves usable partial output if a run is interrupted.
+    Fallback rows are counted as failed receipts, not as items.
+    """
+    writer.writerows(records)
+    stats['receipts'] += 1
+    
+    if any('error' in record for record in records):
+        stats['failed'] += 1
+        return
+    
+    for field in SUMMARY_FIELDS:
+        stats[field] += sum(1 for record in records if record.get(field) not in _MISSING)
+    stats['items'] += len(records)
+
+async def process_receipt_with_ai(ocr_text, filename, records=None):
+    """
+    Extract items from a single receipt's OCR text using improved AI extraction.
+    
+    records is the receipt's regex parse when the caller already has it; it
+    feeds both the deterministic shortcut and the fallback row's header.
+    """
+    
+    if records is None:
+        records = parse_with_regexes(ocr_text, filename)
     
     try:
-        # Extract OCR text
-        text = pytesseract.image_to_string(Image.open(filepath), lang='aze')
-        
-        # Get all items with AI
-        items = extract_items_with_ai(text, filename)
+        # Get all items with AI (cached across runs)
+        items = await extract_items_cached(ocr_text, filename, records)
         
         if not items:
-            items = create_fallback_data(filename)
-        
-        # Update progress counter
-        with counter_lock:
-            processed_count += 1
-            logger.info(f"Processed {processed_count}/62: {filename} - Found {len(items)} items")
-        
-        return items
+            items = create_fallback_data(filename, records)
         
     except Exception as e:
         logger.error(f"Error processing {filename}: {e}")
-        with counter_lock:
-            processed_count += 1
-        return create_fallback_data(filename)
+        items = create_fallback_data(filename, records)
+    
+    return items
 
-def process_batch(batch_files, batch_num):
+async def process_receipts(image_files, writer, stats):
     """
-    Process a batch of receipts with optimized threading.
+    Run OCR and AI extraction as a two-stage pipeline, streaming results to OUTPUT_CSV.
+    
+    OCR is CPU-bound and runs in a process pool; each receipt's API call is
+    awaited on the event loop as soon as its OCR finishes, with at most
+    MAX_WORKERS requests in flight, so Tesseract and OpenAI requests overlap
+    without a thread per request.
     """
     
-    batch_results = []
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all files in batch with optimized futures
-        futures = []
-        for filename in batch_files:
-            filepath = os.path.join(RECEIPTS_DIR, filename)
-            future = executor.submit(process_receipt_with_ai, filepath, filename)
-            futures.append((future, filename))
+    # Receipts with identical OCR text (duplicate scans) await the same API task
+    api_tasks = {}
+    
+    async def extract_limited(text, filename):
+        async with semaphore:
+            return await process_receipt_with_ai(text, filename)
+    
+    async def process_file(filename):
+        try:
+            text = await loop.run_in_executor(ocr_pool, get_ocr, os.path.join(RECEIPTS_DIR, filename))
+        except Exception as e:
+            logger.error(f"OCR failed for {filename}: {e}")
+            append_receipt_to_csv(writer, create_fallback_data(filename, error='OCR failed'), stats)
+            return
         
-        # Collect results with timeout optimization
-        for future, filename in futures:
+        key = ocr_text_key(text)
+        duplicate = key in api_tasks
+        if duplicate:
+            logger.info(f"{filename} has the same OCR text as an earlier receipt, reusing its result")
+        else:
+            api_tasks[key] = asyncio.ensure_future(extract_limited(text, filename))
+        
+        items = await api_tasks[key]  # Each receipt returns multiple items
+        if duplicate:
+            # Only shared results need copying; a receipt's own rows already carry its filename
+            items = relabel_items(items, filename)
+        append_receipt_to_csv(writer, items, stats)
+        logger.info(f"Processed {stats['receipts']}/{len(image_files)}: {filename} - Found {len(items)} items")
+    
+    with ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_ocr_worker) as ocr_pool:
+        await asyncio.gather(*(process_file(filename) for filename in image_files))
+
+async def process_receipts_batch(image_files, writer, stats):
+    """
+    Run OCR for all receipts, then extract items through the OpenAI Batch API.
+    
+    Receipts already in the AI cache are not resubmitted; receipts the batch
+    could not handle are retried through the real-time path. Results are
+    streamed to OUTPUT_CSV.
+    """
+    
+    loop = asyncio.get_running_loop()
+    ocr_texts = {}
+    
+    with ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_ocr_worker) as ocr_pool:
+        results = await asyncio.gather(
+            *(loop.run_in_executor(ocr_pool, get_ocr, os.path.join(RECEIPTS_DIR, filename))
+              for filename in image_files),
+            return_exceptions=True
+        )
+    
+    for filename, result in zip(image_files, results):
+        if isinstance(result, Exception):
+            logger.error(f"OCR failed for {filename}: {result}")
+            append_receipt_to_csv(writer, create_fallback_data(filename, error='OCR failed'), stats)
+        else:
+            ocr_texts[filename] = result
+    
+    pending = {}
+    parsed = {}  # Regex parses, reused for the real-time retry and fallback rows
+    for filename, text in ocr_texts.items():
+        parsed[filename] = parse_with_regexes(text, filename)
+        items = extract_items_deterministic(parsed[filename], filename) or load_cached_items(text, filename)
+        if items is not None:
+            append_receipt_to_csv(writer, items, stats)
+        else:
+            pending[filename] = text
+    
+    # Submit each distinct OCR text once; duplicate scans reuse the first file's result
+    first_filename = {}
+    for filename, text in pending.items():
+        first_filename.setdefault(ocr_text_key(text), filename)
+    
+    batch_results = {}
+    if pending:
+        batch_results = await asyncio.to_thread(run_batch_extraction, {f: pending[f] for f in first_filename.values()})
+    
+    missed = []
+    for first in first_filename.values():
+        if batch_results.get(first):
+            store_cached_items(pending[first], batch_results[first])
+        else:
+            logger.warning(f"No batch result for {first}, falling back to a real-time request")
+            missed.append(first)
+    
+    # Retry the misses concurrently so they share packed requests like the real-time path
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
+    
+    async def extract_limited(filename):
+        async with semaphore:
+            return await process_receipt_with_ai(pending[filename], filename, parsed[filename])
+    
+    retried = await asyncio.gather(*(extract_limited(filename) for filename in missed))
+    batch_results.update(zip(missed, retried))
+    
+    for filename, text in pending.items():
+        items = batch_results[first_filename[ocr_text_key(text)]]
+        append_receipt_to_csv(writer, relabel_items(items, filename), stats)
+
+async def process_receipts_vision(image_files, writer, stats):
+    """
+    Extract items straight from the receipt images, with no OCR stage.
+    
+    At most MAX_WORKERS requests are in flight; results are streamed to OUTPUT_CSV.
+    """
+    
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
+    
+    async def process_file(filename):
+        async with semaphore:
             try:
-                result = future.result(timeout=60)  # 60s timeout per receipt
-                batch_results.extend(result)  # Each receipt returns multiple items
+                items = await extract_items_from_image(os.path.join(RECEIPTS_DIR, filename), filename)
             except Exception as e:
                 logger.error(f"Error processing {filename}: {e}")
-                batch_results.extend(create_fallback_data(filename))
+                items = []
+            
+            if not items:
+                items = create_fallback_data(filename, error='Vision extraction failed')
+        
+        append_receipt_to_csv(writer, items, stats)
+        logger.info(f"Processed {stats['receipts']}/{len(image_files)}: {filename} - Found {len(items)} items")
     
-    logger.info(f"Batch {batch_num}: {len(batch_results)} records")
-    return batch_results
+    await asyncio.gather(*(process_file(filename) for filename in image_files))
+
+def parse_args():
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Extract receipt data with OCR and GPT-4o.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--batch', action='store_true',
+        help="submit receipts through the OpenAI Batch API (50%% cheaper, results within 24h)"
+    )
+    mode.add_argument(
+        '--vision', action='store_true',
+        help="send the receipt images to the model instead of Tesseract OCR text"
+    )
+    return parser.parse_args()
 
 def main():
     """Main function to run improved AI-enhanced receipt processing."""
     
-    global processed_count
+    args = parse_args()
     
     # Check if OpenAI API key is available
     if not os.getenv('openai'):
@@ -475,93 +1265,49 @@ def main():
     
     logger.info("🚀 Starting OPTIMIZED AI-enhanced receipt processing...")
     
-    all_receipts_data = []
-    
-    # Get image files
-    image_files = [f for f in os.listdir(RECEIPTS_DIR) if f.lower().endswith(('.jpeg', '.jpg', '.png', '.tiff'))]
+    # Get image files, largest first so the slowest OCR/API work starts early
+    # instead of trailing at the end of the run (ties broken by name)
+    entries = [entry for entry in os.scandir(RECEIPTS_DIR)
+               if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS]
+    entries.sort(key=lambda entry: (-entry.stat().st_size, entry.name))
+    image_files = [entry.name for entry in entries]
     
     total_files = len(image_files)
-    total_batches = (total_files + BATCH_SIZE - 1) // BATCH_SIZE
-    logger.info(f"📊 Processing {total_files} receipts in {total_batches} batches ({BATCH_SIZE} per batch, {MAX_WORKERS} workers)")
+    logger.info(f"📊 Processing {total_files} receipts ({OCR_WORKERS} OCR processes, {MAX_WORKERS} concurrent API requests)")
     
-    # Process in batches with progress tracking
     start_time = time.time()
-    for i in range(0, total_files, BATCH_SIZE):
-        batch_files = image_files[i:i+BATCH_SIZE]
-        batch_num = (i // BATCH_SIZE) + 1
-        
-        batch_start = time.time()
-        logger.info(f"⚡ Batch {batch_num}/{total_batches} ({len(batch_files)} files)")
-        
-        batch_results = process_batch(batch_files, batch_num)
-        all_receipts_data.extend(batch_results)
-        
-        batch_time = time.time() - batch_start
-        avg_time_per_receipt = batch_time / len(batch_files)
-        remaining_files = total_files - (i + len(batch_files))
-        eta = (remaining_files / BATCH_SIZE) * batch_time
-        
-        logger.info(f"✅ Batch {batch_num} completed in {batch_time:.1f}s ({avg_time_per_receipt:.1f}s/receipt) - ETA: {eta:.0f}s")
-        
-        # Minimal rate limiting for speed
-        if batch_num < total_batches:
-            time.sleep(0.5)
-    
-    # Create DataFrame
-    df = pd.DataFrame(all_receipts_data)
-    
-    # Define column order (30 columns)
-    column_order = [
-        'filename', 'store_name', 'store_address', 'store_code', 'taxpayer_name',
-        'tax_id', 'receipt_number', 'cashier_name', 'date', 'time',
-        'item_name', 'quantity', 'unit_price', 'line_total', 'subtotal',
-        'vat_18_percent', 'total_tax', 'cashless_payment', 'cash_payment', 'bonus_payment',
-        'advance_payment', 'credit_payment', 'queue_number', 'cash_register_model',
-        'cash_register_serial', 'fiscal_id', 'fiscal_registration', 'refund_amount',
-        'refund_date', 'refund_time'
-    ]
-    
-    # Ensure all columns exist
-    for col in column_order:
-        if col not in df.columns:
-            df[col] = None
-    
-    # Reorder columns - handle pandas version differences
-    try:
-        df = df.reindex(columns=column_order)
-    except Exception as e:
-        logger.warning(f"Column reordering failed: {e}. Using existing column order.")
-        # Ensure basic required columns exist
-        for col in ['filename', 'item_name', 'quantity', 'unit_price', 'line_total']:
-            if col not in df.columns:
-                df[col] = None
-    
-    # Save to CSV - fix pandas version compatibility
-    try:
-        df.to_csv(OUTPUT_CSV, index=False, encoding='utf-8')
-    except AttributeError:
-        # Fallback for older pandas versions
-        df.reset_index(drop=True).to_csv(OUTPUT_CSV, index=False, encoding='utf-8')
+    stats = Counter()
+    # Line-buffered so every finished receipt is on disk immediately (tail -f friendly)
+    with open(OUTPUT_CSV, 'w', newline='', encoding='utf-8', buffering=1) as output:
+        writer = csv.DictWriter(output, fieldnames=COLUMN_ORDER, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        if args.batch:
+            asyncio.run(process_receipts_batch(image_files, writer, stats))
+        elif args.vision:
+            asyncio.run(process_receipts_vision(image_files, writer, stats))
+        else:
+            asyncio.run(process_receipts(image_files, writer, stats))
     
     total_time = time.time() - start_time
     avg_time_per_receipt = total_time / total_files
     
     logger.info(f"🎯 OPTIMIZED AI extraction complete! Data saved to '{OUTPUT_CSV}'")
     logger.info(f"⏱️ Total processing time: {total_time:.1f}s ({avg_time_per_receipt:.1f}s/receipt)")
-    logger.info(f"📊 Total records: {len(df)} | Unique receipts: {len(df['filename'].unique())}")
+    logger.info(f"📊 Total records: {stats['items']} | Unique receipts: {stats['receipts']}")
     
     # Show performance summary
     print("\n=== 🚀 OPTIMIZED EXTRACTION SUMMARY ===")
     print(f"🏁 Processing completed in {total_time:.1f} seconds")
     print(f"⚡ Average speed: {avg_time_per_receipt:.1f}s per receipt")
-    print(f"📁 Total receipts processed: {len(df['filename'].unique())}")
-    print(f"📋 Total items extracted: {len(df)}")
-    print(f"📈 Average items per receipt: {len(df) / len(df['filename'].unique()):.1f}")
-    print(f"🏪 Receipts with store names: {len(df[df['store_name'].notna()])}")
-    print(f"📍 Receipts with addresses: {len(df[df['store_address'].notna()])}")
-    print(f"🛒 Receipts with item data: {len(df[df['item_name'].notna()])}")
-    print(f"📅 Receipts with date/time: {len(df[df['date'].notna()])}")
+    print(f"📁 Total receipts processed: {stats['receipts']}")
+    print(f"📋 Total items extracted: {stats['items']}")
+    print(f"⚠️ Receipts with no items extracted: {stats['failed']}")
+    print(f"📈 Average items per receipt: {stats['items'] / stats['receipts']:.1f}")
+    print(f"🏪 Receipts with store names: {stats['store_name']}")
+    print(f"📍 Receipts with addresses: {stats['store_address']}")
+    print(f"🛒 Receipts with item data: {stats['item_name']}")
+    print(f"📅 Receipts with date/time: {stats['date']}")
     print(f"💰 Processing cost est: ${total_files * 0.03:.2f} (approx)")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,21 +1,114 @@
 import os
 import re
-import pandas as pd
+import csv
+import subprocess
+import tempfile
 from PIL import Image
 import pytesseract
 import logging
 
-# Configure logging to hide unnecessary output and show errors
-logging.basicConfig(level=logging.ERROR)
-
 # --- CONFIGURATION ---
 # Set the path to your Tesseract installation if it's not in your system's PATH
 # For Windows: pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 # For Linux/macOS, it's often found automatically if installed via package managers.
 
 RECEIPTS_DIR = 'data/receipts'
+IMAGE_EXTENSIONS = frozenset({'.jpeg', '.jpg', '.png', '.tiff'})
 OUTPUT_CSV = 'data/traditional.csv'
 
+# The exact 30 columns in the required order (replaced payment_methods with 5 payment types)
+COLUMN_ORDER = [
+    'filename', 'store_name', 'store_address', 'store_code', 'taxpayer_name',
+    'tax_id', 'receipt_number', 'cashier_name', 'date', 'time',
+    'item_name', 'quantity', 'unit_price', 'line_total', 'subtotal',
+    'vat_18_percent', 'total_tax', 'cashless_payment', 'cash_payment', 'bonus_payment', 'advance_payment', 'credit_payment',
+    'queue_number', 'cash_register_model', 'cash_register_serial', 'fiscal_id', 'fiscal_registration',
+    'refund_amount', 'refund_date', 'refund_time'
+]
+
+# Item-name cleanup (see clean_item_name): VAT codes, "ƏDV-dən azad" and
+# "Ticarət əlavəsi" prefixes and edge quotes, stripped in one pass
+_NAME_CLEAN_RE = re.compile(
+    r'^(?:v?"?ƏDV[:\s]*\d+[:\s]*|ƏDV-dən\s+azad\s+|Ticarət\s+əlavəsi[:\s]*\d*\s*|["\']+)+|["\']+$'
+)
+_QUOTES_RE = re.compile(r'["\']+')
+_WS_RE = re.compile(r'\s+')
+
+# Enhanced regex patterns handling OCR variations and character encoding issues,
+# compiled once at import instead of looked up on every receipt
+_PATTERN_FLAGS = re.MULTILINE | re.DOTALL
+FIELD_PATTERNS = {
+    # Store name should be extracted from taxpayer name (more reliable)
+    'store_name_temp': re.compile(r'Vergi\s*ödəyicisinin\s*adı[:\s]*(.*?)(?:\n.*?)?(?:\nVÖEN|\nMƏHDUD|\nCƏMİYYƏTİ|\n|$)', _PATTERN_FLAGS),
+    
+    # Store address with variations
+    'store_address': re.compile(r'(?:Obyektin\s*ünvanı|fani)[:\s]*(.*?)(?:\n|$)', _PATTERN_FLAGS),
+    
+    # Store code with variations  
+    'store_code': re.compile(r'(?:Obyektin\s*kodu|ÖV.*?obyektin\s*kodu)[:\s]*([\d\-]+)', _PATTERN_FLAGS),
+    
+    # Taxpayer name - handle multiline
+    'taxpayer_name': re.compile(r'Vergi\s*ödəyicisinin\s*adı[:\s]*(.*?)(?:\n.*?)?(?:\nVÖEN|\nMƏHDUD|\nCƏMİYYƏTİ|\n|$)', _PATTERN_FLAGS),
+    
+    # VOEN number (tax ID)
+    'tax_id': re.compile(r'VÖEN[:\s]*(\d+)', _PATTERN_FLAGS),
+    
+    # Receipt number - handle special characters
+    'receipt_number': re.compile(r'Satış\s*çeki\s*[№#NоМә]*\s*(\d+)', _PATTERN_FLAGS),
+    
+    # Cashier name - exclude date patterns
+    'cashier_name': re.compile(r'Kassir[:\s]*((?!Tarix)[^\n\d]*?)(?:\s+Tarix|\n|$)', _PATTERN_FLAGS),
+    
+    # Date and time with better matching
+    'datetime': re.compile(r'Tarix[:\s]*(\d{2}\.\d{2}\.\d{4})\s*Vaxt[:\s]*(\d{2}:\d{2}:\d{2})', _PATTERN_FLAGS),
+    
+    # Subtotal with variations
+    'subtotal': re.compile(r'Cəmi\s+(\d+\.\d{2})', _PATTERN_FLAGS),
+    
+    # VAT 18% with multiple formats
+    'vat_18_percent': re.compile(r'ƏDV\s*18%?\s*=\s*(\d+\.\d{2})', _PATTERN_FLAGS),
+    
+    # Total tax
+    'total_tax': re.compile(r'Toplam\s*vergi\s*=\s*(\d+\.\d{2})', _PATTERN_FLAGS),
+    
+    # Payment methods - handle OCR variations
+    'cashless_payment': re.compile(r'Nağdsız[:\s]*(\d+\.\d{2})', _PATTERN_FLAGS),
+    'cash_payment': re.compile(r'Nağd[:\s]*(\d+\.\d{2})', _PATTERN_FLAGS),
+    'bonus_payment': re.compile(r'Bonus[:\s]*(\d+\.\d{2})', _PATTERN_FLAGS),
+    'advance_payment': re.compile(r'Avans\s*\([^)]*\)[:\s]*(\d+\.\d{2})', _PATTERN_FLAGS),
+    'credit_payment': re.compile(r'Nisyə[:\s]*(\d+\.\d{2})', _PATTERN_FLAGS),
+    
+    # Queue number
+    'queue_number': re.compile(r'Növbə\s*ərzində\s*vurulmuş\s*çek\s*sayı[:\s]*(\d+)', _PATTERN_FLAGS),
+    
+    # NKA model (cash register model)
+    'cash_register_model': re.compile(r'NKA-nın\s*modeli[:\s]*(.*?)(?:\n|$)', _PATTERN_FLAGS),
+    
+    # NKA serial number (cash register serial)
+    'cash_register_serial': re.compile(r'NKA-nın\s*zavod\s*nömrəsi[:\s]*(.*?)(?:\n|$)', _PATTERN_FLAGS),
+    
+    # Fiscal ID - handle İ/I variations
+    'fiscal_id': re.compile(r'Fiskal\s*[İI]D[:\s]*(\S+)', _PATTERN_FLAGS),
+    
+    # NMQ registration (fiscal registration)
+    'fiscal_registration': re.compile(r'NMQ-nin\s*qeydiyyat\s*nömrəsi[:\s]*(.*?)(?:\n|$)', _PATTERN_FLAGS),
+    
+    # Refund amount
+    'refund_amount': re.compile(r'Geri\s*qaytarılan\s*məbləğ[:\s]*(\d+\.\d{2})', _PATTERN_FLAGS),
+    
+    # Refund date and time
+    'refund_datetime': re.compile(r'Geri\s*qaytarılma\s*tarixi[:\s]*(\d{2}\.\d{2}\.\d{4})\s+(\d{2}:\d{2})', _PATTERN_FLAGS)
+}
+
+_DATE_RE = re.compile(r'.*\d{2}\.\d{2}\.\d{4}')
+_FISCAL_ID_ALT_RE = re.compile(r'Fiskal\s*[İI]D[:\s]*(\w+)', re.IGNORECASE)
+_ITEMS_BLOCK_RE = re.compile(
+    r'Məhsulun adı\s+Say\s+Qiymət\s+Cəmi\s*\n(.*?)(?=\n-+\s*\nCəmi|\nCəmi\s+\d+\.\d{2})',
+    re.DOTALL | re.MULTILINE
+)
+_ITEM_WITH_UNIT_RE = re.compile(r'(.+?)\s*\(([^)]+)\)\s+([\d\.]+)\s+([\d\.]+)\s+([\d\.]+)$')
+_ITEM_RE = re.compile(r'(.+?)\s+([\d\.]+)\s+([\d\.]+)\s+([\d\.]+)$')
+
 def clean_item_name(item_name):
     """
     Clean item name by removing VAT codes and other unwanted prefixes.
@@ -29,25 +122,8 @@ def clean_item_name(item_name):
     if not item_name:
         return ""
     
-    # Remove VAT codes like "ƏDV: 189:", "ƏDV: 1894", "vƏDV: 189:", etc.
-    item_name = re.sub(r'^v?ƏDV[:\s]*\d+[:\s]*', '', item_name)
-    
-    # Handle cases where VAT codes are in the middle with quotes or spaces
-    item_name = re.sub(r'^"?ƏDV[:\s]*\d+[:\s]*', '', item_name)
-    
-    # Remove "ƏDV-dən azad" (VAT-free) prefix
-    item_name = re.sub(r'^ƏDV-dən\s+azad\s+', '', item_name)
-    
-    # Remove "Ticarət əlavəsi:" prefix
-    item_name = re.sub(r'^Ticarət\s+əlavəsi[:\s]*\d*\s*', '', item_name)
-    
-    # Remove quotes at the beginning and end
-    item_name = re.sub(r'^["\']|["\']$', '', item_name)
-    
-    # Clean up extra whitespace
-    item_name = re.sub(r'\s+', ' ', item_name).strip()
-    
-    return item_name
+    # Remove VAT codes, prefixes and surrounding quotes, then collapse whitespace
+    return _WS_RE.sub(' ', _NAME_CLEAN_RE.sub('', item_name)).strip()
 
 def parse_receipt_text(text, filename):
     """
@@ -62,92 +138,15 @@ def parse_receipt_text(text, filename):
               on the receipt, including all 25 required columns.
     """
     
-    # Enhanced regex patterns handling OCR variations and character encoding issues
-    patterns = {
-        # Store name should be extracted from taxpayer name (more reliable)
-        'store_name_temp': r'Vergi\s*ödəyicisinin\s*adı[:\s]*(.*?)(?:\n.*?)?(?:\nVÖEN|\nMƏHDUD|\nCƏMİYYƏTİ|\n|$)',
-        
-        # Store address with variations
-        'store_address': r'(?:Obyektin\s*ünvanı|fani)[:\s]*(.*?)(?:\n|$)',
-        
-        # Store code with variations  
-        'store_code': r'(?:Obyektin\s*kodu|ÖV.*?obyektin\s*kodu)[:\s]*([\d\-]+)',
-        
-        # Taxpayer name - handle multiline
-        'taxpayer_name': r'Vergi\s*ödəyicisinin\s*adı[:\s]*(.*?)(?:\n.*?)?(?:\nVÖEN|\nMƏHDUD|\nCƏMİYYƏTİ|\n|$)',
-        
-        # VOEN number (tax ID)
-        'tax_id': r'VÖEN[:\s]*(\d+)',
-        
-        # Receipt number - handle special characters
-        'receipt_number': r'Satış\s*çeki\s*[№#NоМә]*\s*(\d+)',
-        
-        # Cashier name - exclude date patterns
-        'cashier_name': r'Kassir[:\s]*((?!Tarix)[^\n\d]*?)(?:\s+Tarix|\n|$)',
-        
-        # Date and time with better matching
-        'datetime': r'Tarix[:\s]*(\d{2}\.\d{2}\.\d{4})\s*Vaxt[:\s]*(\d{2}:\d{2}:\d{2})',
-        
-        # Subtotal with variations
-        'subtotal': r'Cəmi\s+(\d+\.\d{2})',
-        
-        # VAT 18% with multiple formats
-        'vat_18_percent': r'ƏDV\s*18%?\s*=\s*(\d+\.\d{2})',
-        
-        # Total tax
-        'total_tax': r'Toplam\s*vergi\s*=\s*(\d+\.\d{2})',
-        
-        # Payment methods - handle OCR variations
-        'cashless_payment': r'Nağdsız[:\s]*(\d+\.\d{2})',
-        'cash_payment': r'Nağd[:\s]*(\d+\.\d{2})',
-        'bonus_payment': r'Bonus[:\s]*(\d+\.\d{2})',
-        'advance_payment': r'Avans\s*\([^)]*\)[:\s]*(\d+\.\d{2})',
-        'credit_payment': r'Nisyə[:\s]*(\d+\.\d{2})',
-        
-        # Queue number
-        'queue_number': r'Növbə\s*ərzində\s*vurulmuş\s*çek\s*sayı[:\s]*(\d+)',
-        
-        # NKA model (cash register model)
-        'cash_register_model': r'NKA-nın\s*modeli[:\s]*(.*?)(?:\n|$)',
-        
-        # NKA serial number (cash register serial)
-        'cash_register_serial': r'NKA-nın\s*zavod\s*nömrəsi[:\s]*(.*?)(?:\n|$)',
-        
-        # Fiscal ID - handle İ/I variations
-        'fiscal_id': r'Fiskal\s*[İI]D[:\s]*(\S+)',
-        
-        # NMQ registration (fiscal registration)
-        'fiscal_registration': r'NMQ-nin\s*qeydiyyat\s*nömrəsi[:\s]*(.*?)(?:\n|$)',
-        
-        # Refund amount
-        'refund_amount': r'Geri\s*qaytarılan\s*məbləğ[:\s]*(\d+\.\d{2})',
-        
-        # Refund date and time
-        'refund_datetime': r'Geri\s*qaytarılma\s*tarixi[:\s]*(\d{2}\.\d{2}\.\d{4})\s+(\d{2}:\d{2})'
-    }
-
-    # Extract general receipt info
-    data = {}
-    
-    # Initialize all 30 columns with None (replaced payment_methods with 5 payment types)
-    columns = [
-        'filename', 'store_name', 'store_address', 'store_code', 'taxpayer_name',
-        'tax_id', 'receipt_number', 'cashier_name', 'date', 'time',
-        'item_name', 'quantity', 'unit_price', 'line_total', 'subtotal',
-        'vat_18_percent', 'total_tax', 'cashless_payment', 'cash_payment', 'bonus_payment', 'advance_payment', 'credit_payment',
-        'queue_number', 'cash_register_model', 'cash_register_serial', 'fiscal_id', 'fiscal_registration',
-        'refund_amount', 'refund_date', 'refund_time'
-    ]
-    
-    for col in columns:
-        data[col] = None
+    # Extract general receipt info, starting with all 30 columns set to None
+    data = dict.fromkeys(COLUMN_ORDER)
     
     # Set filename
     data['filename'] = filename
     
     # Extract fields using patterns
-    for key, pattern in patterns.items():
-        match = re.search(pattern, text, re.MULTILINE | re.DOTALL)
+    for key, pattern in FIELD_PATTERNS.items():
+        match = pattern.search(text)
         if match:
             if key == 'datetime':
                 data['date'] = match.group(1)
@@ -159,21 +158,21 @@ def parse_receipt_text(text, filename):
                 # Clean up taxpayer name by removing extra whitespace and newlines
                 taxpayer_text = match.group(1).strip()
                 # Remove quotes and extra formatting
-                taxpayer_text = re.sub(r'["\']+', '', taxpayer_text)
-                taxpayer_text = re.sub(r'\s+', ' ', taxpayer_text)
+                taxpayer_text = _QUOTES_RE.sub('', taxpayer_text)
+                taxpayer_text = _WS_RE.sub(' ', taxpayer_text)
                 data[key] = taxpayer_text
             elif key == 'store_name_temp':
                 # Use taxpayer name as store name (more reliable)
                 store_text = match.group(1).strip()
                 # Remove quotes and extra formatting
-                store_text = re.sub(r'["\']+', '', store_text)
-                store_text = re.sub(r'\s+', ' ', store_text)
+                store_text = _QUOTES_RE.sub('', store_text)
+                store_text = _WS_RE.sub(' ', store_text)
                 data['store_name'] = store_text
             elif key == 'cashier_name':
                 # Clean cashier name - remove common OCR artifacts
                 cashier_text = match.group(1).strip()
                 # Skip if it looks like a date
-                if not re.match(r'.*\d{2}\.\d{2}\.\d{4}', cashier_text):
+                if not _DATE_RE.match(cashier_text):
                     data[key] = cashier_text
             else:
                 data[key] = match.group(1).strip()
@@ -181,7 +180,7 @@ def parse_receipt_text(text, filename):
     # Additional fallback patterns for critical missing fields
     if not data.get('fiscal_id'):
         # Try alternative fiscal ID patterns
-        fiscal_alt = re.search(r'Fiskal\s*[İI]D[:\s]*(\w+)', text, re.IGNORECASE)
+        fiscal_alt = _FISCAL_ID_ALT_RE.search(text)
         if fiscal_alt:
             data['fiscal_id'] = fiscal_alt.group(1).strip()
     
@@ -207,10 +206,7 @@ def parse_receipt_text(text, filename):
     items_data = []
     try:
         # Find the items section more precisely
-        items_block_match = re.search(
-            r'Məhsulun adı\s+Say\s+Qiymət\s+Cəmi\s*\n(.*?)(?=\n-+\s*\nCəmi|\nCəmi\s+\d+\.\d{2})', 
-            text, re.DOTALL | re.MULTILINE
-        )
+        items_block_match = _ITEMS_BLOCK_RE.search(text)
         
         if items_block_match:
             items_block = items_block_match.group(1)
@@ -223,11 +219,11 @@ def parse_receipt_text(text, filename):
                 line = item_lines[i].strip()
                 
                 # Enhanced regex for item parsing - handles various formats
-                item_match = re.match(r'(.+?)\s*\(([^)]+)\)\s+([\d\.]+)\s+([\d\.]+)\s+([\d\.]+)$', line)
+                item_match = _ITEM_WITH_UNIT_RE.match(line)
                 
                 if not item_match:
                     # Try without unit indicator
-                    item_match = re.match(r'(.+?)\s+([\d\.]+)\s+([\d\.]+)\s+([\d\.]+)$', line)
+                    item_match = _ITEM_RE.match(line)
                 
                 if item_match:
                     if len(item_match.groups()) == 5:  # With unit indicator
@@ -255,7 +251,7 @@ def parse_receipt_text(text, filename):
                 elif i + 1 < len(item_lines):
                     # Handle multi-line item names
                     combined_line = f"{line} {item_lines[i+1].strip()}"
-                    item_match = re.match(r'(.+?)\s+([\d\.]+)\s+([\d\.]+)\s+([\d\.]+)$', combined_line)
+                    item_match = _ITEM_RE.match(combined_line)
                     if item_match:
                         item_name = item_match.group(1).strip()
                         quantity = float(item_match.group(2))
@@ -292,6 +288,40 @@ def parse_receipt_text(text, filename):
         
     return full_receipt_data
 
+def ocr_images_batch(filepaths, lang='aze'):
+    """
+    OCR several images with a single tesseract invocation.
+
+    Tesseract reads the image paths from a list file and separates pages with a
+    form feed, so the language model is loaded once for the whole folder instead
+    of once per image.
+
+    Returns:
+        list: One text per image in filepaths order, or None if tesseract failed
+        or its output could not be split back into one text per image.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as list_file:
+        list_file.write('\n'.join(filepaths) + '\n')
+
+    try:
+        result = subprocess.run(
+            [pytesseract.pytesseract.tesseract_cmd, list_file.name, 'stdout', '-l', lang],
+            capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error(f"Batch OCR failed, falling back to per-image OCR: {e}")
+        return None
+    finally:
+        os.remove(list_file.name)
+
+    pages = result.stdout.decode('utf-8').split('\f')
+    if len(pages) == len(filepaths) + 1 and not pages[-1].strip():
+        pages.pop()  # Some tesseract versions also end the last page with a separator
+    if len(pages) != len(filepaths):
+        logging.error(f"Batch OCR returned {len(pages)} pages for {len(filepaths)} images, falling back to per-image OCR")
+        return None
+    return pages
+
 def process_receipts_folder(directory, output_file):
     """
     Processes all images in a directory, extracts receipt data, and saves to CSV.
@@ -305,18 +335,23 @@ def process_receipts_folder(directory, output_file):
     print(f"Starting processing of receipts in '{directory}'...")
     
     # Get a list of image files to process
-    image_files = [f for f in os.listdir(directory) if f.lower().endswith(('.jpeg', '.jpg', '.png', '.tiff'))]
+    image_files = sorted(entry.name for entry in os.scandir(directory)
+                         if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS)
     
     if not image_files:
         print("No image files found in the directory.")
         return
 
-    for filename in image_files:
-        filepath = os.path.join(directory, filename)
+    # OCR the whole folder in one tesseract run; fall back to one call per image
+    filepaths = [os.path.join(directory, filename) for filename in image_files]
+    texts = ocr_images_batch(filepaths) or [None] * len(filepaths)
+
+    for filename, filepath, text in zip(image_files, filepaths, texts):
         try:
             print(f"Processing {filename}...")
-            # Use pytesseract to do OCR on the image, specifying Azerbaijani language
-            text = pytesseract.image_to_string(Image.open(filepath), lang='aze')
+            if text is None:
+                # Use pytesseract to do OCR on the image, specifying Azerbaijani language
+                text = pytesseract.image_to_string(Image.open(filepath), lang='aze')
             
             # Parse the extracted text
             parsed_data = parse_receipt_text(text, filename)
@@ -331,31 +366,17 @@ def process_receipts_folder(directory, output_file):
         print("No data could be extracted from any of the images.")
         return
 
-    # Create a DataFrame and save it to a CSV file
-    df = pd.DataFrame(all_receipts_data)
-    
-    # Define the exact 30 columns in the required order (replaced payment_methods with 5 payment types)
-    column_order = [
-        'filename', 'store_name', 'store_address', 'store_code', 'taxpayer_name',
-        'tax_id', 'receipt_number', 'cashier_name', 'date', 'time',
-        'item_name', 'quantity', 'unit_price', 'line_total', 'subtotal',
-        'vat_18_percent', 'total_tax', 'cashless_payment', 'cash_payment', 'bonus_payment', 'advance_payment', 'credit_payment',
-        'queue_number', 'cash_register_model', 'cash_register_serial', 'fiscal_id', 'fiscal_registration',
-        'refund_amount', 'refund_date', 'refund_time'
-    ]
-    
-    # Ensure all columns exist in the dataframe
-    for col in column_order:
-        if col not in df.columns:
-            df[col] = None
-    
-    # Reorder columns to match the required 30-column structure
-    df = df.reindex(columns=column_order)
-
-    df.to_csv(output_file, index=False, encoding='utf-8')
+    # Save with the fixed 30-column layout; keys outside it (e.g. 'error') are dropped
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMN_ORDER, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(all_receipts_data)
     print(f"\n✅ Success! All data has been extracted and saved to '{output_file}'")
 
 
 # --- RUN THE SCRIPT ---
 if __name__ == '__main__':
+    # Configure logging to hide unnecessary output and show errors; done here
+    # rather than at import so ai_parse can reuse parse_receipt_text
+    logging.basicConfig(level=logging.ERROR)
     process_receipts_folder(RECEIPTS_DIR, OUTPUT_CSV)
\ No newline at end of file